@@ -30,5 +30,5 @@ processing based on mutual information, written in Python.
 Currently, only the functionality for sliding two images
 on top of each other is implemented.
 ''',
-    requires=['numpy']
+    requires=['numpy', 'scipy', 'numba']
 )
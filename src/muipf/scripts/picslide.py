@@ -14,10 +14,12 @@ other so that the most suitable overlap arises, in terms of mutual information.
 
 import os
 import argparse
-import multiprocessing
 import logging
-from tqdm import tqdm
-from joblib import Parallel, delayed
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit, prange
+from scipy.fft import rfft2, irfft2, next_fast_len
+from scipy.special import xlogy
 from skimage.io import imread
 import numpy as np
 
@@ -27,6 +29,7 @@ from muipf.scripts.common import ScriptError, print_line
 VERSION = (0, 1)
 MIOUT = 'hypersurface.dat'
 CCOUT = 'hypersurface_cc.dat'
+METHODS = ('direct', 'fft')
 
 
 USAGE = \
@@ -77,6 +80,11 @@ def parse_cmdline_args(cmdlineargs=None):
     parser.add_argument('-b', '--binning', dest='entriesperbin',
                         default=50, type=int, help=msg)
 
+    msg = 'method of the hypersurface calculation ({})'.format(
+        ', '.join(METHODS))
+    parser.add_argument('-m', '--method', dest='method', default=METHODS[0],
+                        type=str, choices=METHODS, help=msg)
+
     msg = 'if cross correlation should be calculated'
     parser.add_argument('-c', '--ccorr', dest='tccorr', action='store_true',
                         help=msg)
@@ -118,19 +126,23 @@ def picslide(args):
     ccoutfile = args.ccoutfile
 
     entriesperbin = args.entriesperbin
+    method = args.method
     tccorr = args.tccorr
     logging.info('Finished parsing arguments')
 
 
     logging.info('Starting reading images')
-    try:
-        print('Reading images...')
-        baseim = np.asarray(imread(infiles[0], as_gray=True))
-        print('base image: ', infiles[0])
-        subim = np.asarray(imread(infiles[1], as_gray=True))
-        print('sub image: ', infiles[1])
-    except FileNotFoundError as exc:
-        raise ScriptError('Invalid infile path(s) specified.') from exc
+    print('Reading images...')
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        # decode both images concurrently
+        futures = [executor.submit(read_image, infile) for infile in infiles]
+        try:
+            baseim = futures[0].result()
+            subim = futures[1].result()
+        except FileNotFoundError as exc:
+            raise ScriptError('Invalid infile path(s) specified.') from exc
+    print('base image: ', infiles[0])
+    print('sub image: ', infiles[1])
     print_line()
     logging.info('Finished reading images')
 
@@ -143,16 +155,11 @@ def picslide(args):
     print_line()
     logging.info('Finished individual entropy calculation')
 
-    hsize = np.shape(baseim)[0] - np.shape(subim)[0]
-    vsize = np.shape(baseim)[1] - np.shape(subim)[1]
-    logging.info('Starting generation of displacement vectors')
-    shifts = get_displacement_vectors(hsize, vsize)
-    logging.info('Finished generation of displacement vectors')
-
     # calculate mutual information hypersurface
     logging.info('Starting hypersurface calculation')
     print('Calculating mutual information hypersurface...')
-    mi = scan_hypersurface(baseim, subim, entropysub, shifts, entriesperbin)
+    mi = scan_hypersurface(baseim, subim, entropysub, entriesperbin,
+                           method)
     logging.info('Finished hypersurface calculation')
     print('obtained properties:')
     print('min: {0:.6f}\nmax: {1:.6f}\nmean: {2:.6f}\nrms: {3:.6f}'
@@ -172,53 +179,48 @@ def picslide(args):
     print(msg)
 
 
-def get_max_position(array):
-    '''Get position of maximum value in input array.
+def read_image(fname):
+    '''Reads an image from file and converts it to grayscale.
 
     Args:
 
-        array (ndarray): arbitrary array
+        fname (str): path to image file
 
     Returns:
 
-        indices (tupel): contains coordinates of maximum entry
+        image (2darray): single precision array representing the image
 
     '''
 
-    logging.debug('Enter function: get_max_position')
+    logging.debug('Enter function: read_image')
 
-    indices = np.unravel_index(np.argmax(array, axis=None), array.shape)
+    image = np.asarray(imread(fname, as_gray=True), dtype=np.float32)
 
-    return indices
+    return image
 
 
-def get_displacement_vectors(hsize, vsize):
-    '''Established list of displacement vectors that cover the entire space.
+def get_max_position(array):
+    '''Get position of maximum value in input array.
 
     Args:
 
-        hsize (int): range of horizontal pixel index
-        vsize (list): range of vertical pixel index
+        array (ndarray): arbitrary array
 
     Returns:
 
-        shifts (list): list of displacement vectors
+        indices (tupel): contains coordinates of maximum entry
 
     '''
 
-    logging.debug('Enter function: get_displacement_vectors')
-
-    shifts = []
+    logging.debug('Enter function: get_max_position')
 
-    for hpixel in range(hsize):
-        for vpixel in range(vsize):
-            shift = np.array([hpixel, vpixel])
-            shifts.append(shift)
+    indices = np.unravel_index(np.argmax(array, axis=None), array.shape)
 
-    return shifts
+    return indices
 
 
-def scan_hypersurface(baseim, subim, subentropy, shifts, entriesperbin):
+def scan_hypersurface(baseim, subim, subentropy, entriesperbin,
+                      method='direct'):
     '''Calculates the full mutual information hypersurface.
 
     Args:
@@ -226,8 +228,10 @@ def scan_hypersurface(baseim, subim, subentropy, shifts, entriesperbin):
         baseim (2darray): array representing the base image
         subim (2darray): array representing the sub image
         subentropy (float): individual entropy of the sub image
-        shifts (list): list of displacement vectors
         entriesperbin (int): targeted number of entries per bin
+        method (str): either count the histograms of every displacement
+            directly ('direct') or obtain them for all displacements at once
+            via FFT based cross correlations ('fft')
 
     Returns:
 
@@ -237,138 +241,373 @@ def scan_hypersurface(baseim, subim, subentropy, shifts, entriesperbin):
 
     logging.debug('Enter function: scan_hypersurface')
 
-    calc = lambda shift: scan_hypersurface_point(
-        baseim, subim, subentropy, shift, entriesperbin)
+    hsize = np.shape(baseim)[0] - np.shape(subim)[0]
+    vsize = np.shape(baseim)[1] - np.shape(subim)[1]
+
+    mi = np.empty((hsize, vsize), dtype=np.float64)
+
+    # ignore parts of base image that have no overlap with the sub image
+    # therefore the total amount of bins is determined by the sub image
+    nbins = int(np.sqrt(subim.size / entriesperbin))
+    nbinsbase = int(subim.size / entriesperbin)
+
+    # quantize both images only once, so that all displacements share the
+    # same bin edges and the joint histograms reduce to integer counting
+    baserange = (np.amin(baseim), np.amax(baseim))
+    qbase = quantize(baseim, nbins, baserange)
+    qsub = quantize(subim, nbins)
+    qbasefine = quantize(baseim, nbinsbase, baserange)
 
-    num_cores = multiprocessing.cpu_count()
-    mi = Parallel(n_jobs=num_cores)(delayed(calc)(shift) for shift in
-                                    tqdm(shifts))
+    if method == 'fft':
+        scan = scan_all_fft
+    else:
+        scan = scan_all
 
-    mi = np.reshape(mi, (np.shape(baseim)[0] - np.shape(subim)[0],
-                         np.shape(baseim)[1] - np.shape(subim)[1]))
+    scan(qbase, qbasefine, qsub, nbins, nbinsbase, subentropy, mi)
 
     return mi
 
 
-def scan_hypersurface_point(baseim, subim, subentropy, shift, entriesperbin):
-    '''Calculates the mutual information of a single hypersurface point.
+@njit(parallel=True, cache=True)
+def scan_all(qbase, qbasefine, qsub, nbins, nbinsbase, subentropy, mi):
+    '''Calculates the mutual information of all displacements in parallel.
+       Rows of the hypersurface are distributed among the threads, while the
+       individual histogram of the base image is updated incrementally when
+       sliding from one column to the next.
 
     Args:
 
-        baseim (2darray): array representing the base image
-        subim (2darray): array representing the sub image
+        qbase (2darray): bin indices of the quantized base image
+        qbasefine (2darray): bin indices of the base image, quantized for the
+            calculation of its individual entropy
+        qsub (2darray): bin indices of the quantized sub image
+        nbins (int): number of bins per image of the joint histogram
+        nbinsbase (int): number of bins of the individual base histogram
         subentropy (float): individual entropy of the sub image
-        shift (1darray): displacement vector
-        entriesperbin (int): targeted number of entries per bin
+        mi (2darray): mutual information hypersurface to fill, its shape
+            determines the range of horizontal and vertical pixel index
+
+    '''
+
+    nrows, ncols = qsub.shape
+
+    # with -sum(p * log(p)) = log(N) - sum(c * log(c)) / N, all entropies are
+    # obtained from tabulated summands of the integer counts
+    clogc = get_clogc_table(qsub.size)
+
+    for hpixel in prange(mi.shape[0]):
+
+        # thread-local histograms of the current displacement
+        counts = np.zeros(nbinsbase, dtype=np.int64)
+        jcounts = np.zeros(nbins * nbins, dtype=np.int64)
+
+        for irow in range(nrows):
+            for icol in range(ncols):
+                counts[qbasefine[hpixel + irow, icol]] += 1
+
+        countsum = 0.0
+        for ibin in range(nbinsbase):
+            countsum += clogc[counts[ibin]]
+
+        for vpixel in range(mi.shape[1]):
+
+            # sliding the window by one column only affects the individual
+            # histogram of the base image at the dropped and added column
+            if vpixel > 0:
+                for irow in range(nrows):
+                    ibin = qbasefine[hpixel + irow, vpixel - 1]
+                    countsum += clogc[counts[ibin] - 1] - clogc[counts[ibin]]
+                    counts[ibin] -= 1
+                    ibin = qbasefine[hpixel + irow, vpixel + ncols - 1]
+                    countsum += clogc[counts[ibin] + 1] - clogc[counts[ibin]]
+                    counts[ibin] += 1
+
+            # in contrast, every pixel pair of the joint histogram changes
+            jcountsum = get_joint_clogc_sum(
+                qbase[hpixel:hpixel + nrows, vpixel:vpixel + ncols], qsub,
+                nbins, clogc, jcounts)
+
+            # the log(N) terms of the individual and joint entropy cancel
+            mi[hpixel, vpixel] = subentropy \
+                + (jcountsum - countsum) / qsub.size
+
+
+@njit(cache=True)
+def get_clogc_table(total):
+    '''Tabulates the entropy summands c * log(c) of all possible counts.
+
+    Args:
+
+        total (int): maximum count, i.e. number of histogram entries
 
     Returns:
 
-        mi (float): corresponding mutual information
+        clogc (1darray): summand of every count in range [0, total]
 
     '''
 
-    logging.debug('Enter function: scan_hypersurface_point')
+    clogc = np.zeros(total + 1, dtype=np.float64)
+    for count in range(2, total + 1):
+        clogc[count] = count * np.log(count)
 
-    basesubview = baseim[shift[0]:np.shape(subim)[0] + shift[0],
-                         shift[1]:np.shape(subim)[1] + shift[1]]
+    return clogc
 
-    baseentropy = get_entropy(basesubview, entriesperbin)
-    jentropy = get_joint_entropy(baseim, subim, shift, entriesperbin)
 
-    mi = get_mutual_information(baseentropy, subentropy, jentropy)
+@njit(cache=True)
+def get_joint_clogc_sum(qwindow, qsub, nbins, clogc, jcounts):
+    '''Counts the joint histogram of two quantized images of equal shape and
+       sums up the tabulated entropy summands of its entries.
 
-    return mi
+    Args:
 
+        qwindow (2darray): bin indices of the base image window, covered by
+            the sub image
+        qsub (2darray): bin indices of the quantized sub image
+        nbins (int): number of bins per image of the joint histogram
+        clogc (1darray): tabulated entropy summands of all possible counts
+        jcounts (1darray): buffer of the flattened joint histogram, which is
+            overwritten
 
-def get_entropy(image, entriesperbin):
-    '''Calculates the entropy of an individual image.
+    Returns:
+
+        jcountsum (float): sum of c * log(c) over all joint histogram entries
+
+    '''
+
+    jcounts[:] = 0
+    for irow in range(qsub.shape[0]):
+        for icol in range(qsub.shape[1]):
+            jcounts[qwindow[irow, icol] * nbins + qsub[irow, icol]] += 1
+
+    jcountsum = 0.0
+    for ibin in range(nbins * nbins):
+        jcountsum += clogc[jcounts[ibin]]
+
+    return jcountsum
+
+
+def scan_all_fft(qbase, qbasefine, qsub, nbins, nbinsbase, subentropy, mi):
+    '''Calculates the mutual information of all displacements at once. Every
+       joint histogram entry is the cross correlation of the indicator planes
+       of the corresponding bins, which is evaluated for all displacements via
+       FFT. Entries of the individual base histogram are window sums of a
+       single indicator plane, obtained from its summed-area table.
 
     Args:
 
-        image (2darray): array representing an image
-        entriesperbin (int): targeted number of entries per bin
+        qbase (2darray): bin indices of the quantized base image
+        qbasefine (2darray): bin indices of the base image, quantized for the
+            calculation of its individual entropy
+        qsub (2darray): bin indices of the quantized sub image
+        nbins (int): number of bins per image of the joint histogram
+        nbinsbase (int): number of bins of the individual base histogram
+        subentropy (float): individual entropy of the sub image
+        mi (2darray): mutual information hypersurface to fill, its shape
+            determines the range of horizontal and vertical pixel index
+
+    '''
+
+    logging.debug('Enter function: scan_all_fft')
+
+    hsize, vsize = np.shape(mi)
+
+    # the joint entropy summands are accumulated in place
+    mi[:, :] = subentropy + get_window_entropies(
+        qbasefine, np.shape(qsub), nbinsbase, np.shape(mi))
+
+    # the sub image never wraps around the base image for the displacements
+    # of interest, therefore no padding beyond a fast FFT size is needed
+    shape = get_fast_shape(*np.shape(qbase))
+    dtype = get_fft_dtype(qbase, qsub, shape)
+
+    # spectra of all non-empty indicator planes of the sub image, reused for
+    # every base bin. the planes are transformed one at a time, since a
+    # batched transform would hold all of them in the FFT precision at once
+    subfft = [np.conj(rfft2((qsub == ibin).astype(dtype), s=shape,
+                            workers=-1))
+              for ibin in range(nbins) if np.any(qsub == ibin)]
+
+    for ibin in range(nbins):
+        mask = qbase == ibin
+        if not mask.any():
+            continue
+        basefft = rfft2(mask.astype(dtype), s=shape, workers=-1)
+        for isubfft in subfft:
+            jcounts = irfft2(basefft * isubfft, s=shape, workers=-1)
+            jcounts = jcounts[:hsize, :vsize]
+            jhist = np.rint(jcounts).astype(np.float64) / qsub.size
+            mi += xlogy(jhist, jhist)
+
+
+def get_window_entropies(qimage, winshape, nbins, gridshape):
+    '''Calculates the entropy of the windows of a quantized image, for all
+       displacements of the window. The histogram entries are window sums of
+       the indicator planes, obtained from their summed-area tables.
+
+    Args:
+
+        qimage (2darray): bin indices of the quantized image
+        winshape (tupel): number of rows and columns of the window
+        nbins (int): number of bins
+        gridshape (tupel): number of horizontal and vertical displacements
 
     Returns:
 
-        entropy (float): corresponding entropy
+        entropy (2darray): window entropy of every displacement
 
     '''
 
-    logging.debug('Enter function: get_entropy')
+    logging.debug('Enter function: get_window_entropies')
 
-    nbins = int(image.size / entriesperbin)
+    nrows, ncols = winshape
+    hsize, vsize = gridshape
 
-    hist, _ = np.histogram(image, bins=nbins, density=False)
-    hist = hist / image.size
+    entropy = np.zeros(gridshape, dtype=np.float64)
 
-    histlog = np.log(hist, out=np.zeros_like(hist), where=(hist != 0.0))
+    # summed-area table with leading row and column of zeros, so that the
+    # window sums of all displacements follow from four shifted views
+    sat = np.zeros((np.shape(qimage)[0] + 1, np.shape(qimage)[1] + 1),
+                   dtype=np.int64)
 
-    # calculate entropy of the image
-    entropy = - np.dot(hist, histlog)
+    for ibin in range(nbins):
+        mask = qimage == ibin
+        if not mask.any():
+            continue
+        np.cumsum(np.cumsum(mask, axis=0), axis=1, out=sat[1:, 1:])
+        counts = sat[nrows:nrows + hsize, ncols:ncols + vsize] \
+            - sat[:hsize, ncols:ncols + vsize] \
+            - sat[nrows:nrows + hsize, :vsize] + sat[:hsize, :vsize]
+        hist = counts / (nrows * ncols)
+        entropy -= xlogy(hist, hist)
 
     return entropy
 
 
-def get_joint_entropy(baseim, subim, shift, entriesperbin):
-    '''Calculates the joint entropy of two images, for a displacement vector
-       defining their relative positions to each other. The displacement vector
-       points from the upper left corner of the base image to the upper left
-       corner of the sub image.
+def get_fft_dtype(qbase, qsub, shape):
+    '''Selects the floating point precision of the FFT based cross
+       correlations of the indicator planes of two quantized images.
 
     Args:
 
-        baseim (2darray): array representing the base image
-        subim (2darray): array representing the sub image
-        shift (1darray): displacement vector
-        entriesperbin (int): targeted number of entries per bin
+        qbase (2darray): bin indices of the quantized base image
+        qsub (2darray): bin indices of the quantized sub image
+        shape (tupel): padded shape of the FFTs
 
     Returns:
 
-        jentropy (float): corresponding joint entropy
+        dtype (type): single precision if the counts are safely recovered
+            by rounding, otherwise double precision
 
     '''
 
-    logging.debug('Enter function: get_joint_entropy')
+    logging.debug('Enter function: get_fft_dtype')
 
-    # ignore parts of base image that have no overlap with the sub image
-    # therefore the total amount of bins is determined by the sub image
-    nbins = int(np.sqrt(subim.size / entriesperbin))
+    # the rounding error of a correlation of indicator planes, populated by
+    # na and nb pixels, grows like eps * log2(size) * sqrt(na * nb), while
+    # observed errors stay at about a fifth of this estimate. single
+    # precision is only used if it leaves a wide margin to the integer
+    # spacing of the counts, which are rounded afterwards
+    maxpop = float(np.amax(np.bincount(qbase.ravel()))) \
+        * float(np.amax(np.bincount(qsub.ravel())))
+    errestimate = np.finfo(np.float32).eps * np.log2(shape[0] * shape[1]) \
+        * np.sqrt(maxpop)
+
+    if errestimate < 0.05:
+        dtype = np.float32
+    else:
+        dtype = np.float64
+
+    return dtype
+
+
+@lru_cache(maxsize=8)
+def get_fast_shape(nrows, ncols):
+    '''Determines the smallest padded shape of real-valued 2D FFTs, that is
+       efficiently handled. Results are cached, since images of the same
+       resolution lead to the same FFT shapes.
+
+    Args:
+
+        nrows (int): minimum number of rows
+        ncols (int): minimum number of columns
+
+    Returns:
+
+        shape (tupel): padded number of rows and columns
+
+    '''
+
+    logging.debug('Enter function: get_fast_shape')
+
+    shape = (next_fast_len(nrows, real=True), next_fast_len(ncols, real=True))
+
+    return shape
+
+
+def quantize(image, nbins, vrange=None):
+    '''Maps the pixel values of an image onto equally spaced bins, covering
+       the value range of the image.
+
+    Args:
+
+        image (2darray): array representing an image
+        nbins (int): number of bins
+        vrange (tupel): minimum and maximum pixel value of the image, to
+            avoid recalculation for multiple binnings (default: None)
+
+    Returns:
+
+        qimage (2darray): bin index of every pixel, in range [0, nbins)
+
+    '''
+
+    logging.debug('Enter function: quantize')
 
-    subview = baseim[shift[0]:np.shape(subim)[0] + shift[0],
-                     shift[1]:np.shape(subim)[1] + shift[1]]
+    # smallest unsigned integer type that is able to hold the bin indices
+    dtype = np.min_scalar_type(nbins)
 
-    jhist, _, _ = np.histogram2d(subview.flatten(), subim.flatten(),
-                                 bins=nbins, density=False)
-    jhist = jhist.flatten()
-    jhist = jhist / subim.size
+    if vrange is None:
+        vrange = (np.amin(image), np.amax(image))
+    imin, imax = vrange
 
-    jhistlog = np.log(jhist, out=np.zeros_like(jhist), where=(jhist != 0.0))
+    # constant images populate a single bin
+    if imax == imin:
+        return np.zeros(np.shape(image), dtype=dtype)
 
-    # calculate joint entropies as negative summed product of all entries
-    jentropy = - np.dot(jhist, jhistlog)
+    qimage = ((image - imin) / (imax - imin) * nbins).astype(dtype)
+    # the maximum value would open up a bin of its own
+    qimage = np.clip(qimage, 0, nbins - 1)
 
-    return jentropy
+    return qimage
 
 
-def get_mutual_information(entr1, entr2, entr12):
-    '''Based on the individual entropies of two images and their joint entropy,
-       the corresponding mutual information gets calculated and returned.
+def get_entropy(image, entriesperbin):
+    '''Calculates the entropy of an individual image.
 
     Args:
 
-        entr1 (float): entropy of the first individual image
-        entr2 (float): entropy of the second individual image
-        entr12 (float): joint entropy of the images
+        image (2darray): array representing an image
+        entriesperbin (int): targeted number of entries per bin
 
     Returns:
 
-        mi (float): corresponding mutual information
+        entropy (float): corresponding entropy
 
     '''
 
-    logging.debug('Enter function: get_mutual_information')
+    logging.debug('Enter function: get_entropy')
+
+    nbins = int(image.size / entriesperbin)
+
+    qimage = quantize(image, nbins)
+
+    hist = np.bincount(qimage.ravel(), minlength=nbins)
+    hist = hist / image.size
+
+    # calculate entropy of the image, where empty bins do not contribute
+    entropy = - np.sum(xlogy(hist, hist))
 
-    return entr1 + entr2 - entr12
+    return entropy
 
 
 def get_cross_correlation(baseim, subim):
@@ -387,13 +626,27 @@ def get_cross_correlation(baseim, subim):
 
     logging.debug('Enter function: get_cross_correlation')
 
-    padded_si = (np.pad(subim, ((0, np.shape(baseim)[0] - np.shape(subim)[0]),
-                                (0, np.shape(baseim)[1] - np.shape(subim)[1]))))
+    nrows, ncols = np.shape(baseim)
+    nsubrows, nsubcols = np.shape(subim)
+
+    # pad to sizes that hold all lags of the linear cross correlation and
+    # that are efficiently handled by the FFT
+    shape = get_fast_shape(nrows + nsubrows - 1, ncols + nsubcols - 1)
+
+    basefft = rfft2(baseim, s=shape, workers=-1)
+    subfft = rfft2(subim, s=shape, workers=-1)
+
+    lccorr = irfft2(basefft * np.conj(subfft), s=shape, workers=-1)
 
-    basefft = np.fft.fft2(baseim)
-    subfft = np.fft.fft2(padded_si)
+    # wrap negative lags around, to obtain the periodic cross correlation
+    # of the base image sized FFT
+    ccorr = lccorr[:nrows, :ncols].copy()
+    ccorr[nrows - nsubrows + 1:, :] += lccorr[shape[0] - nsubrows + 1:, :ncols]
+    ccorr[:, ncols - nsubcols + 1:] += lccorr[:nrows, shape[1] - nsubcols + 1:]
+    ccorr[nrows - nsubrows + 1:, ncols - nsubcols + 1:] += \
+        lccorr[shape[0] - nsubrows + 1:, shape[1] - nsubcols + 1:]
 
-    ccorr = np.abs(np.fft.ifft2(basefft * np.conj(subfft)))
+    ccorr = np.abs(ccorr)
 
     return ccorr
 
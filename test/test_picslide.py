@@ -14,6 +14,7 @@ Regression tests for the picslide command line script.
 import sys
 import os.path
 import unittest
+import numpy as np
 from muipf.scripts.common import ScriptError
 import muipf.scripts.picslide as picslide
 import common
@@ -85,6 +86,45 @@ class PicslideTest(common.TestInWorkDir):
         self.assertTrue(equal)
 
 
+    def test_core_fft(self):
+        '''Testcase for core functionality, based on FFT cross correlations.'''
+
+        infile1 = self.get_full_inpath('grass_base.png')
+        infile2 = self.get_full_inpath('grass_sub.png')
+
+        reffile = self.get_full_inpath('hypersurface_ref_grass.dat')
+        outfile = self.get_full_outpath('hypersurface_cur_grass.dat')
+
+        cmdargs = [infile1, infile2, '-m', 'fft', '-o', outfile]
+
+        with common.OutputCatcher() as _:
+            picslide.main(cmdargs)
+
+        equal = common.hypersurface_file_equals(outfile, reffile)
+
+        self.assertTrue(equal)
+
+
+    def test_fft_large_uniform(self):
+        '''Testcase for the FFT based hypersurface of large, mostly uniform
+           images, which must match the direct counting of histograms.'''
+
+        rng = np.random.default_rng(2)
+        baseim = (rng.random((1050, 1060)) < 0.01).astype(np.float32)
+        subim = baseim[5:1015, 5:1035].copy()
+
+        subentropy = picslide.get_entropy(subim, 50)
+        mifft = picslide.scan_hypersurface(baseim, subim, subentropy, 50,
+                                           method='fft')
+        midirect = picslide.scan_hypersurface(baseim, subim, subentropy, 50,
+                                              method='direct')
+
+        equal = np.allclose(mifft, midirect, rtol=common.RTOL,
+                            atol=common.ATOL)
+
+        self.assertTrue(equal)
+
+
     def test_with_ccorr(self):
         '''Testcase for additional cross correlation calculation.'''
 